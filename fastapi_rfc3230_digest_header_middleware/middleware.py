@@ -1,68 +1,489 @@
 """Module that implements a middleware for FastAPI to handle RFC 3230 Digest headers."""
 
-from typing import Callable, MutableMapping, Any, Awaitable
+import binascii
+import functools
+import hashlib
+import hmac
+import re
+from types import MappingProxyType
+from typing import Callable, Awaitable, Iterable
 from rfc3230_digest_headers import DigestHeaderAlgorithm
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
-from starlette.responses import Response
+from rfc3230_digest_headers.rfc3230 import HeaderShouldBeAdded
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect, Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
+_HASHLIB_NAMES: dict[DigestHeaderAlgorithm, str] = {
+    DigestHeaderAlgorithm.MD5: "md5",
+    DigestHeaderAlgorithm.SHA: "sha1",
+    DigestHeaderAlgorithm.SHA256: "sha256",
+    DigestHeaderAlgorithm.SHA512: "sha512",
+}
+"""Algorithms that can be computed incrementally with `hashlib`, mapped to their `hashlib` names."""
 
-class Middleware(BaseHTTPMiddleware):
+
+_THREADPOOL_MIN_BYTES = 1024 * 1024
+"""Instances of at least this size are hashed in the threadpool. `hashlib` releases the GIL while hashing, so concurrent requests are hashed in parallel without blocking the event loop."""
+
+_NO_BODY_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+"""Methods whose requests carry no body, so they are not validated unless an `instance_bytes_callback` is configured."""
+
+_DEFAULT_QVALUES: MappingProxyType[DigestHeaderAlgorithm, float | None] = (
+    MappingProxyType({DigestHeaderAlgorithm.SHA256: None})
+)
+"""The q-values used when none are configured. Only SHA-256 is allowed."""
+
+_EMPTY: dict[str, str] = {}
+"""Headers passed to the library when the request has no `Digest` header. Must not be mutated."""
+
+_DIGEST_PART_RE = re.compile(rb"\s*([^=\s]+(?:\s+[^=\s]+)*)\s*=\s*(\S+(?:\s+\S+)*)\s*")
+"""Matches one `algorithm=digest` part of a `Digest` header, capturing the non-empty algorithm and digest."""
+
+
+def _compare_digest(provided_digest: bytes, digest: bytes) -> bool:
+    """Compare a base64-encoded digest from a `Digest` header with a computed binary digest in constant time.
+
+    The computed digest is encoded instead of decoding the client's value, so the client's value is never parsed.
+    Like `DigestHeaderAlgorithm.verify_request`, only the canonical base64 encoding matches.
+
+    Args:
+        provided_digest: The base64-encoded digest sent by the client.
+        digest: The digest computed by the server.
+
+    Returns:
+        `True` if the digests match, `False` otherwise.
+    """
+    return hmac.compare_digest(
+        binascii.b2a_base64(digest, newline=False), provided_digest
+    )
+
+
+def _verify_digest(
+    alg: DigestHeaderAlgorithm, provided_digest: bytes, instance_bytes: bytes
+) -> bool:
+    """Verify a single provided digest against the instance bytes.
+
+    Args:
+        alg: The algorithm of the provided digest.
+        provided_digest: The digest sent by the client.
+        instance_bytes: The instance bytes the digest was created from.
+
+    Returns:
+        `True` if the digest matches, `False` otherwise.
+    """
+    hash_name = _HASHLIB_NAMES.get(alg)
+    if hash_name is None:
+        # The checksums are not base64-encoded, so compare their string representations.
+        return hmac.compare_digest(
+            alg.compute(instance_bytes).encode(), provided_digest
+        )
+    return _compare_digest(
+        provided_digest, hashlib.new(hash_name, instance_bytes).digest()
+    )
+
+
+async def _verify_digest_async(
+    alg: DigestHeaderAlgorithm, provided_digest: bytes, instance_bytes: bytes
+) -> bool:
+    """Like `_verify_digest`, but hashes large instances in the threadpool."""
+    if len(instance_bytes) < _THREADPOOL_MIN_BYTES:
+        return _verify_digest(alg, provided_digest, instance_bytes)
+    return await run_in_threadpool(_verify_digest, alg, provided_digest, instance_bytes)
+
+
+_FAIL_PREFIX = b"Digest validation failed with: "
+"""Prefix of the response body of rejections with an error description."""
+
+_HEADER_ADDED_BODY = b"Digest header added."
+"""Response body of rejections without an error description."""
+
+_TOO_LARGE_BODY = b"Request body too large."
+"""Response body of the `413 Content Too Large` response."""
+
+_PAYLOAD_TOO_LARGE: tuple[list[tuple[bytes, bytes]], bytes] = (
+    [
+        (b"content-length", str(len(_TOO_LARGE_BODY)).encode()),
+        (b"content-type", b"text/plain; charset=utf-8"),
+    ],
+    _TOO_LARGE_BODY,
+)
+"""The encoded headers and body of the `413 Content Too Large` response."""
+
+
+class _BodyTooLargeError(Exception):
+    """Raised by the `receive` channel of `_limit_receive` once the body exceeds the limit."""
+
+
+@functools.lru_cache(maxsize=64)
+def _encode_rejection(
+    header_should_be_added: HeaderShouldBeAdded,
+) -> tuple[list[tuple[bytes, bytes]], bytes]:
+    """Encode the response for a request that failed the Digest header validation.
+
+    The error descriptions only depend on the configured algorithms, so the encoded responses are cached.
+    The returned headers must not be modified.
+
+    Args:
+        header_should_be_added: The header to add to the response, describing the validation error.
+
+    Returns:
+        A tuple `(headers, body)` with the raw ASGI response headers and the response body.
+    """
+    body = (
+        _FAIL_PREFIX + header_should_be_added.error_description.encode()
+        if header_should_be_added.error_description
+        else _HEADER_ADDED_BODY
+    )
+    headers = [
+        (b"content-length", str(len(body)).encode()),
+        (b"content-type", b"text/plain; charset=utf-8"),
+        (
+            header_should_be_added.header_name.lower().encode("latin-1"),
+            header_should_be_added.header_value.encode("latin-1"),
+        ),
+    ]
+    return headers, body
+
+
+async def _send_rejection(
+    send: Send,
+    rejection: tuple[list[tuple[bytes, bytes]], bytes],
+    status_code: int = 400,
+) -> None:
+    """Send a response created by `_encode_rejection`.
+
+    Args:
+        send: The ASGI `send` channel.
+        rejection: The encoded headers and body of the response.
+        status_code: The status code of the response.
+    """
+    headers, body = rejection
+    # Outer middlewares may modify the messages in place, so never share them between requests.
+    await send(
+        {"type": "http.response.start", "status": status_code, "headers": list(headers)}
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def _limit_receive(receive: Receive, max_body_bytes: int) -> Receive:
+    """Create a `receive` channel that raises `_BodyTooLargeError` once the request body exceeds a limit.
+
+    Args:
+        receive: The original `receive` channel.
+        max_body_bytes: The maximum number of body bytes allowed.
+
+    Returns:
+        The limited `receive` channel.
+    """
+    received_bytes = 0
+
+    async def limited_receive() -> Message:
+        nonlocal received_bytes
+        message = await receive()
+        if message["type"] == "http.request":
+            received_bytes += len(message.get("body", b""))
+            if received_bytes > max_body_bytes:
+                raise _BodyTooLargeError
+        return message
+
+    return limited_receive
+
+
+def _record_receive(receive: Receive) -> tuple[Receive, list[Message]]:
+    """Create a `receive` channel that records all `http.request` messages it returns.
+
+    Args:
+        receive: The original `receive` channel.
+
+    Returns:
+        A tuple `(receive, messages)` with the recording `receive` channel and the list the messages are recorded in.
+    """
+    messages: list[Message] = []
+
+    async def recording_receive() -> Message:
+        message = await receive()
+        if message["type"] == "http.request":
+            messages.append(message)
+        return message
+
+    return recording_receive, messages
+
+
+def _replay_receive(messages: list[Message], receive: Receive) -> Receive:
+    """Create a `receive` channel that replays already consumed `http.request` messages.
+
+    Args:
+        messages: The consumed messages, in the order they were received.
+        receive: The original `receive` channel. Used for all messages after the replayed ones, e.g. the rest of a partially consumed body or `http.disconnect`.
+
+    Returns:
+        The `receive` channel to pass to the wrapped application.
+    """
+    pending = iter(messages)
+
+    async def replay() -> Message:
+        message = next(pending, None)
+        if message is None:
+            return await receive()
+        return message
+
+    return replay
+
+
+class Middleware:
     """Middleware to add RFC 3230 Digest header support to FastAPI applications."""
 
     def __init__(
         self,
-        app: Callable[
-            [
-                MutableMapping[str, Any],
-                Callable[[], Awaitable[MutableMapping[str, Any]]],
-                Callable[[MutableMapping[str, Any]], Awaitable[None]],
-            ],
-            Awaitable[None],
-        ],
-        dispatch: (
-            Callable[
-                [Request, Callable[[Request], Awaitable[Response]]], Awaitable[Response]
-            ]
-            | None
-        ) = None,
+        app: ASGIApp,
+        *,
         instance_bytes_callback: Callable[[Request], Awaitable[bytes]] | None = None,
         qvalues: dict[DigestHeaderAlgorithm, float | None] | None = None,
+        max_body_bytes: int | None = None,
+        exempt_paths: Iterable[str | re.Pattern[str]] = (),
     ) -> None:
         """Initialize the middleware.
 
         Args:
             app: The ASGI application.
-            dispatch: Optional custom dispatch function.
             instance_bytes_callback: Optional callback to get the instance bytes from the request. The bytes returned should be the same ones used to initially generate the Digest header.
             qvalues: Optional dictionary of preferred DigestHeaderAlgorithm and their q-values. If not provided, default q-values will be used that only allow SHA-256.
+            max_body_bytes: Optional maximum size of the request body in bytes. Larger requests are rejected with `413 Content Too Large` before their digest is computed. Parts of the body that an `instance_bytes_callback` does not read are limited while the application reads them. If not provided, the size is not limited.
+            exempt_paths: Optional paths that are not validated. Strings must match the request path exactly, patterns must match the whole request path. Without an `instance_bytes_callback`, requests with the methods GET, HEAD and OPTIONS are not validated.
+
+        Raises:
+            TypeError: If `exempt_paths` is a string or contains entries that are neither strings nor string patterns.
         """
-        super().__init__(app, dispatch)
+        self.app = app
         self.instance_bytes_callback = instance_bytes_callback
         self.qvalues = qvalues
-
-    async def dispatch(self, request: Request, call_next) -> Response:
-        instance_bytes = await (
-            self.instance_bytes_callback(request)
-            if self.instance_bytes_callback
-            else request.body()
+        self.max_body_bytes = max_body_bytes
+        # A callback may sign more than the body, e.g. the method and path, so bodiless requests are validated too.
+        self._unvalidated_methods = (
+            _NO_BODY_METHODS if instance_bytes_callback is None else frozenset()
+        )
+        if isinstance(exempt_paths, str):
+            # A single string would be split into its characters, exempting e.g. "/".
+            raise TypeError("exempt_paths must be an iterable of paths, not a string")
+        exempt_exact_paths = set()
+        exempt_path_patterns = []
+        for path in exempt_paths:
+            if isinstance(path, str):
+                exempt_exact_paths.add(path)
+            elif isinstance(path, re.Pattern) and isinstance(path.pattern, str):
+                exempt_path_patterns.append(path)
+            else:
+                raise TypeError(
+                    f"exempt_paths entries must be str or re.Pattern[str], not {path!r}"
+                )
+        self._exempt_exact_paths = frozenset(exempt_exact_paths)
+        self._exempt_path_patterns = tuple(exempt_path_patterns)
+        self._effective_qvalues = qvalues if qvalues is not None else _DEFAULT_QVALUES
+        self._rejected_tokens = frozenset(
+            alg.value.encode()
+            for alg, qvalue in self._effective_qvalues.items()
+            if qvalue == 0.0
+        )
+        acceptable = {
+            alg: 1.0 if qvalue is None else qvalue
+            for alg, qvalue in self._effective_qvalues.items()
+            if qvalue != 0.0
+        }
+        # Sorting is stable, so equally preferred algorithms keep their configured order.
+        accept_ordered = sorted(acceptable, key=lambda alg: -acceptable[alg])
+        # Parallel tuples describing the acceptable algorithms, most preferred first.
+        self._algorithms = tuple(accept_ordered)
+        self._tokens = tuple(alg.value.encode() for alg in accept_ordered)
+        self._hash_names = tuple(_HASHLIB_NAMES.get(alg) for alg in accept_ordered)
+        # The Want-Digest header only depends on the q-values, so it is the same for every rejection.
+        _, missing_digest = DigestHeaderAlgorithm.verify_request(
+            request_headers=_EMPTY, instance=b"", qvalues=self._effective_qvalues
         )
-        digest_header = request.headers.get("Digest")
-        valid, header_should_be_added = DigestHeaderAlgorithm.verify_request(
-            request_headers={"Digest": digest_header} if digest_header else {},
-            instance=instance_bytes,
-            qvalues=self.qvalues,
+        self._missing_digest_rejection = _encode_rejection(missing_digest)
+        self._digest_mismatch_rejection = _encode_rejection(
+            missing_digest._replace(
+                error_description="No Digest value matched for any acceptable algorithm."
+            )
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Validate the `Digest` header of a request and pass it on to the application.
+
+        Valid requests are passed to the application with the original `send` channel, so responses are never wrapped or re-assembled.
+        Only the `receive` channel is replaced if the body had to be read for the validation, or if its size is limited.
+
+        Args:
+            scope: The ASGI scope of the request.
+            receive: The ASGI `receive` channel.
+            send: The ASGI `send` channel.
+        """
+        if (
+            scope["type"] != "http"
+            or scope["method"] in self._unvalidated_methods
+            or scope["path"] in self._exempt_exact_paths
+            or any(
+                pattern.fullmatch(scope["path"])
+                for pattern in self._exempt_path_patterns
+            )
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        # ASGI servers provide lowercased header names, so scan the raw headers once.
+        digest_header = content_length = None
+        for name, value in scope["headers"]:
+            if name == b"digest":
+                if digest_header is None:
+                    digest_header = value
+            elif name == b"content-length":
+                content_length = value
+        if (
+            self.max_body_bytes is not None
+            and content_length is not None
+            and content_length.isdigit()
+            and int(content_length) > self.max_body_bytes
+        ):
+            await _send_rejection(send, _PAYLOAD_TOO_LARGE, 413)
+            return
+        if not digest_header:
+            await _send_rejection(send, self._missing_digest_rejection)
+            return
+        provided_digests = self._parse_digest_header(digest_header)
+        if not provided_digests:
+            # The outcome does not depend on the instance, let the library describe the problem.
+            _, header_should_be_added = DigestHeaderAlgorithm.verify_request(
+                request_headers={"Digest": digest_header.decode("latin-1")},
+                instance=b"",
+                qvalues=self._effective_qvalues,
+            )
+            await _send_rejection(send, _encode_rejection(header_should_be_added))
+            return
+
+        # Only the most preferred provided algorithm is hashed while the body arrives.
+        # The others are only computed if it does not match.
+        (preferred, preferred_digest), *fallback_digests = provided_digests
+        hash_name = self._hash_names[preferred]
+        try:
+            instance_bytes, h, app_receive = await self._read_instance(
+                scope, receive, hash_name
+            )
+        except _BodyTooLargeError:
+            await _send_rejection(send, _PAYLOAD_TOO_LARGE, 413)
+            return
+        if h is not None:
+            valid = _compare_digest(preferred_digest, h.digest())
+        else:
+            valid = await _verify_digest_async(
+                self._algorithms[preferred], preferred_digest, instance_bytes
+            )
+        if not valid:
+            for i, provided_digest in fallback_digests:
+                if await _verify_digest_async(
+                    self._algorithms[i], provided_digest, instance_bytes
+                ):
+                    break
+            else:
+                await _send_rejection(send, self._digest_mismatch_rejection)
+                return
+        try:
+            await self.app(scope, app_receive, send)
+        except _BodyTooLargeError:
+            # The callback did not read the whole body, and the application read past the limit.
+            await _send_rejection(send, _PAYLOAD_TOO_LARGE, 413)
+
+    async def _read_instance(
+        self, scope: Scope, receive: Receive, hash_name: str | None
+    ) -> tuple[bytes, "hashlib._Hash | None", Receive]:
+        """Read the instance bytes of a request.
+
+        Args:
+            scope: The ASGI scope of the request.
+            receive: The original `receive` channel of the request.
+            hash_name: The `hashlib` name of the algorithm to hash the instance with, if it is supported by `hashlib`.
+
+        Returns:
+            A tuple `(instance_bytes, hash, receive)` with the instance bytes, the hash of the instance bytes if `hash_name` was given, and the `receive` channel for the wrapped application.
+
+        Raises:
+            _BodyTooLargeError: If the request body exceeds `max_body_bytes`.
+            ClientDisconnect: If the client disconnected before the body was received.
+        """
+        # Clients may send more than their Content-Length, so also stop reading once the limit is exceeded.
+        body_receive = (
+            receive
+            if self.max_body_bytes is None
+            else _limit_receive(receive, self.max_body_bytes)
         )
-        if header_should_be_added is not None:
-            return Response(
-                content=(
-                    f"Digest validation failed with: {header_should_be_added.error_description}"
-                    if header_should_be_added.error_description
-                    else "Digest header added."
-                ),
-                status_code=400,
-                headers={
-                    header_should_be_added.header_name: header_should_be_added.header_value
-                },
+        if self.instance_bytes_callback:
+            # The callback may consume the body in any way, so record what it read for the application.
+            recording_receive, consumed_messages = _record_receive(body_receive)
+            request = Request(scope, recording_receive)
+            instance_bytes = await self.instance_bytes_callback(request)
+            if hash_name is None:
+                h = None
+            elif len(instance_bytes) < _THREADPOOL_MIN_BYTES:
+                h = hashlib.new(hash_name, instance_bytes)
+            else:
+                h = await run_in_threadpool(hashlib.new, hash_name, instance_bytes)
+            # The application reads the rest of the body through the limited channel as well.
+            return (
+                instance_bytes,
+                h,
+                _replay_receive(consumed_messages, body_receive)
+                if consumed_messages
+                else body_receive,
             )
-        return await call_next(request)
+        # Hash the body while it arrives instead of materializing it first.
+        h = hashlib.new(hash_name) if hash_name else None
+        messages = []
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await body_receive()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnect
+            messages.append(message)
+            chunk = message.get("body", b"")
+            chunks.append(chunk)
+            if h is not None:
+                h.update(chunk)
+            more_body = message.get("more_body", False)
+        # Joining a single chunk returns it as is, so most bodies are never copied.
+        return b"".join(chunks), h, _replay_receive(messages, receive)
+
+    def _parse_digest_header(
+        self, digest_header: bytes
+    ) -> list[tuple[int, bytes]] | None:
+        """Extract the acceptable digests from a `Digest` header.
+
+        Mirrors the parsing rules of `DigestHeaderAlgorithm.verify_request`: unknown and unlisted algorithms are ignored.
+
+        Args:
+            digest_header: The raw value of the `Digest` header.
+
+        Returns:
+            Pairs of the index of each provided acceptable algorithm in `_algorithms` and its digest, most preferred first, or `None` if the header is malformed or contains an algorithm with a q-value of 0.0.
+        """
+        tokens = self._tokens
+        if b"," not in digest_header:
+            # Most clients send a single digest, which needs no reordering.
+            match = _DIGEST_PART_RE.fullmatch(digest_header)
+            if match is None:
+                return None
+            token = match[1].lower()
+            if token in tokens:
+                return [(tokens.index(token), match[2])]
+            if token in self._rejected_tokens:
+                return None
+            return []
+        provided_digests = {}
+        for part in digest_header.split(b","):
+            match = _DIGEST_PART_RE.fullmatch(part)
+            if match is None:
+                return None
+            token = match[1].lower()
+            if token in tokens:
+                provided_digests[tokens.index(token)] = match[2]
+            elif token in self._rejected_tokens:
+                return None
+        return sorted(provided_digests.items())
@@ -1,10 +1,16 @@
 import pytest
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, WebSocket
 from fastapi.testclient import TestClient
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
+from fastapi_rfc3230_digest_header_middleware import middleware as middleware_module
 from fastapi_rfc3230_digest_header_middleware.middleware import Middleware
 from rfc3230_digest_headers import DigestHeaderAlgorithm
+import asyncio
+import base64
+import hashlib
 import json
+import re
+import string
 
 
 @pytest.fixture
@@ -49,12 +55,32 @@ def test_invalid_digest_header(app: FastAPI):
     assert b"No Digest value matched" in response.content
 
 
+def test_non_canonical_digest(app: FastAPI):
+    client = TestClient(app)
+    body = b"hello world"
+    digest = base64.b64encode(hashlib.sha256(body).digest()).decode()
+    alphabet = string.ascii_uppercase + string.ascii_lowercase + string.digits + "+/"
+    # Both decode to the correct digest, but only the canonical encoding matches
+    non_canonical_digests = [
+        digest[:-2] + alphabet[alphabet.index(digest[-2]) | 1] + "=",
+        digest + "=",
+    ]
+    for non_canonical_digest in non_canonical_digests:
+        assert base64.b64decode(non_canonical_digest) == hashlib.sha256(body).digest()
+        response = client.post(
+            "/echo", content=body, headers={"Digest": f"sha-256={non_canonical_digest}"}
+        )
+        assert response.status_code == 400
+        assert b"No Digest value matched" in response.content
+
+
 def test_missing_digest_header(app: FastAPI):
     client = TestClient(app)
     body = b"hello world"
     response = client.post("/echo", content=body)
     assert response.status_code == 400
     assert b"Missing Digest header" in response.content
+    assert response.headers["Want-Digest"] == "sha-256"
 
 
 def test_reject_disallowed():
@@ -151,3 +177,497 @@ def test_instance_bytes_callback_partial_json():
     )
     assert response.status_code == 400
     assert b"No Digest value matched" in response.content
+
+
+def test_streamed_body(app: FastAPI):
+    client = TestClient(app)
+    chunks = [b"a" * 65536, b"b" * 65536, b"c" * 10]
+    body = b"".join(chunks)
+    digest = DigestHeaderAlgorithm.make_digest_header(
+        body, algorithms=[DigestHeaderAlgorithm.SHA256]
+    )
+    response = client.post(
+        "/echo",
+        content=iter(chunks),
+        headers={digest.header_name: digest.header_value},
+    )
+    assert response.status_code == 200
+    assert response.content == body
+
+
+def test_multiple_digests():
+    qvalues = {
+        DigestHeaderAlgorithm.SHA256: None,
+        DigestHeaderAlgorithm.SHA512: 0.5,
+    }
+    app = FastAPI()
+    app.add_middleware(Middleware, qvalues=qvalues)
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        body = await request.body()
+        return Response(content=body)
+
+    client = TestClient(app)
+    body = b"hello world"
+    sha512 = DigestHeaderAlgorithm.SHA512.compute(body)
+
+    # Only one of the provided digests has to match
+    response = client.post(
+        "/echo",
+        content=body,
+        headers={"Digest": f"unknown=abc, SHA-256=invalid, SHA-512={sha512}"},
+    )
+    assert response.status_code == 200
+    assert response.content == body
+
+    response = client.post("/echo", content=body, headers={"Digest": "sha-256"})
+    assert response.status_code == 400
+    assert b"Malformed Digest header" in response.content
+
+
+def test_websocket_passthrough(app: FastAPI):
+    @app.websocket("/ws")
+    async def ws(websocket: WebSocket):
+        await websocket.accept()
+        await websocket.send_text(await websocket.receive_text())
+        await websocket.close()
+
+    client = TestClient(app)
+    with client.websocket_connect("/ws") as websocket:
+        websocket.send_text("hello")
+        assert websocket.receive_text() == "hello"
+
+
+def test_checksum_algorithm():
+    app = FastAPI()
+    app.add_middleware(Middleware, qvalues={DigestHeaderAlgorithm.UNIXSUM: None})
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        body = await request.body()
+        return Response(content=body)
+
+    client = TestClient(app)
+    body = b"hello world"
+    digest = DigestHeaderAlgorithm.make_digest_header(
+        body, algorithms=[DigestHeaderAlgorithm.UNIXSUM]
+    )
+    response = client.post(
+        "/echo", content=body, headers={digest.header_name: digest.header_value}
+    )
+    assert response.status_code == 200
+    assert response.content == body
+
+    response = client.post("/echo", content=body, headers={"Digest": "unixsum=1"})
+    assert response.status_code == 400
+    assert b"No Digest value matched" in response.content
+
+
+def test_max_body_bytes():
+    app = FastAPI()
+    app.add_middleware(Middleware, max_body_bytes=16)
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        body = await request.body()
+        return Response(content=body)
+
+    client = TestClient(app)
+    body = b"hello world"
+    digest = DigestHeaderAlgorithm.make_digest_header(
+        body, algorithms=[DigestHeaderAlgorithm.SHA256]
+    )
+    response = client.post(
+        "/echo", content=body, headers={digest.header_name: digest.header_value}
+    )
+    assert response.status_code == 200
+    assert response.content == body
+
+    body = b"hello world" * 2
+    digest = DigestHeaderAlgorithm.make_digest_header(
+        body, algorithms=[DigestHeaderAlgorithm.SHA256]
+    )
+    response = client.post(
+        "/echo", content=body, headers={digest.header_name: digest.header_value}
+    )
+    assert response.status_code == 413
+
+    # Without Content-Length the body is limited while it is read
+    response = client.post(
+        "/echo",
+        content=iter([b"hello world", b"hello world"]),
+        headers={digest.header_name: digest.header_value},
+    )
+    assert response.status_code == 413
+
+
+def test_max_body_bytes_with_instance_bytes_callback():
+    async def path_bytes(request: Request) -> bytes:
+        return request.url.path.encode()
+
+    app = FastAPI()
+    app.add_middleware(
+        Middleware, instance_bytes_callback=path_bytes, max_body_bytes=16
+    )
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        body = await request.body()
+        return Response(content=body)
+
+    client = TestClient(app)
+    digest = DigestHeaderAlgorithm.make_digest_header(
+        b"/echo", algorithms=[DigestHeaderAlgorithm.SHA256]
+    )
+    response = client.post(
+        "/echo",
+        content=iter([b"hello world"]),
+        headers={digest.header_name: digest.header_value},
+    )
+    assert response.status_code == 200
+    assert response.content == b"hello world"
+
+    # The callback does not read the body, but the application is limited as well
+    response = client.post(
+        "/echo",
+        content=iter([b"hello world", b"hello world"]),
+        headers={digest.header_name: digest.header_value},
+    )
+    assert response.status_code == 413
+
+
+def test_large_instance(monkeypatch: pytest.MonkeyPatch):
+    threadpool_calls = []
+
+    async def run_in_threadpool(func, *args):
+        threadpool_calls.append(func)
+        return func(*args)
+
+    monkeypatch.setattr(middleware_module, "run_in_threadpool", run_in_threadpool)
+
+    async def body_bytes(request: Request) -> bytes:
+        return await request.body()
+
+    qvalues = {
+        DigestHeaderAlgorithm.SHA256: None,
+        DigestHeaderAlgorithm.SHA512: 0.5,
+    }
+    app = FastAPI()
+    app.add_middleware(Middleware, instance_bytes_callback=body_bytes, qvalues=qvalues)
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        body = await request.body()
+        return Response(content=body)
+
+    client = TestClient(app)
+    body = b"a" * (2 * 1024 * 1024)
+    sha256 = DigestHeaderAlgorithm.SHA256.compute(body)
+    sha512 = DigestHeaderAlgorithm.SHA512.compute(body)
+
+    # Large instances returned by the callback are hashed in the threadpool
+    response = client.post(
+        "/echo", content=body, headers={"Digest": f"sha-256={sha256}"}
+    )
+    assert response.status_code == 200
+    assert response.content == body
+    assert threadpool_calls == [hashlib.new]
+
+    # So are the fallback algorithms
+    threadpool_calls.clear()
+    response = client.post(
+        "/echo",
+        content=body,
+        headers={"Digest": f"sha-256={sha512}, sha-512={sha512}"},
+    )
+    assert response.status_code == 200
+    assert response.content == body
+    assert threadpool_calls == [hashlib.new, middleware_module._verify_digest]
+
+    # Small instances are hashed inline
+    threadpool_calls.clear()
+    small_body = b"hello world"
+    response = client.post(
+        "/echo",
+        content=small_body,
+        headers={
+            "Digest": f"sha-256=invalid, "
+            f"sha-512={DigestHeaderAlgorithm.SHA512.compute(small_body)}"
+        },
+    )
+    assert response.status_code == 200
+    assert threadpool_calls == []
+
+    response = client.post(
+        "/echo", content=body, headers={"Digest": f"sha-256={sha512}"}
+    )
+    assert response.status_code == 400
+
+
+def test_algorithm_preference_order():
+    middleware = Middleware(
+        FastAPI(),
+        qvalues={
+            DigestHeaderAlgorithm.MD5: 0.5,
+            DigestHeaderAlgorithm.SHA512: None,
+            DigestHeaderAlgorithm.SHA: 0.0,
+            DigestHeaderAlgorithm.SHA256: 1.0,
+        },
+    )
+    # Higher q-values first, ties keep the configured order
+    assert middleware._algorithms == (
+        DigestHeaderAlgorithm.SHA512,
+        DigestHeaderAlgorithm.SHA256,
+        DigestHeaderAlgorithm.MD5,
+    )
+
+
+def test_exempt_requests():
+    app = FastAPI()
+    app.add_middleware(
+        Middleware,
+        exempt_paths=[
+            "/public",
+            re.compile(r"/files/(?P<name>[^/]+)"),
+            re.compile(r"/assets/(?P<name>[^/]+)", re.IGNORECASE),
+            re.compile(r"(?i)/docs"),
+        ],
+    )
+
+    @app.get("/echo")
+    async def get_echo():
+        return Response(content=b"get")
+
+    @app.post("/echo")
+    @app.post("/public")
+    @app.post("/files/{name}")
+    @app.post("/ASSETS/{name}")
+    @app.post("/Docs")
+    async def echo(request: Request):
+        body = await request.body()
+        return Response(content=body)
+
+    client = TestClient(app)
+    body = b"hello world"
+
+    response = client.get("/echo")
+    assert response.status_code == 200
+    assert response.content == b"get"
+
+    response = client.post("/public", content=body)
+    assert response.status_code == 200
+    assert response.content == body
+
+    response = client.post("/files/a.txt", content=body)
+    assert response.status_code == 200
+    assert response.content == body
+
+    # Flags of compiled patterns are respected
+    response = client.post("/ASSETS/a.css", content=body)
+    assert response.status_code == 200
+    assert response.content == body
+
+    response = client.post("/Docs", content=body)
+    assert response.status_code == 200
+    assert response.content == body
+
+    response = client.post("/echo", content=body)
+    assert response.status_code == 400
+
+    response = client.post("/PUBLIC", content=body)
+    assert response.status_code == 400
+
+    response = client.post("/files/a/b.txt", content=body)
+    assert response.status_code == 400
+
+
+def test_invalid_exempt_paths():
+    # A single string must not be split into single-character paths such as "/"
+    with pytest.raises(TypeError):
+        Middleware(FastAPI(), exempt_paths="/health")
+
+    with pytest.raises(TypeError):
+        Middleware(FastAPI(), exempt_paths=["/health", 42])
+
+    with pytest.raises(TypeError):
+        Middleware(FastAPI(), exempt_paths=[re.compile(rb"/health")])
+
+
+def test_bodiless_requests_with_instance_bytes_callback():
+    async def method_and_path(request: Request) -> bytes:
+        return f"{request.method} {request.url.path}".encode()
+
+    app = FastAPI()
+    app.add_middleware(Middleware, instance_bytes_callback=method_and_path)
+
+    @app.get("/echo")
+    async def get_echo():
+        return Response(content=b"get")
+
+    client = TestClient(app)
+    # The instance is not the body, so bodiless requests are validated too
+    response = client.get("/echo")
+    assert response.status_code == 400
+    assert b"Missing Digest header" in response.content
+
+    digest = DigestHeaderAlgorithm.make_digest_header(
+        b"GET /echo", algorithms=[DigestHeaderAlgorithm.SHA256]
+    )
+    response = client.get("/echo", headers={digest.header_name: digest.header_value})
+    assert response.status_code == 200
+    assert response.content == b"get"
+
+
+def test_streaming_response(app: FastAPI):
+    @app.post("/stream")
+    async def stream(request: Request):
+        body = await request.body()
+
+        async def chunks():
+            for _ in range(3):
+                await asyncio.sleep(0.01)
+                yield body
+
+        return StreamingResponse(chunks())
+
+    client = TestClient(app)
+    body = b"hello world"
+    digest = DigestHeaderAlgorithm.make_digest_header(
+        body, algorithms=[DigestHeaderAlgorithm.SHA256]
+    )
+    response = client.post(
+        "/stream", content=body, headers={digest.header_name: digest.header_value}
+    )
+    assert response.status_code == 200
+    assert response.content == body * 3
+
+
+def test_parse_digest_header():
+    middleware = Middleware(
+        FastAPI(),
+        qvalues={DigestHeaderAlgorithm.SHA256: None, DigestHeaderAlgorithm.MD5: 0.0},
+    )
+    assert middleware._parse_digest_header(b"SHA-256=abc") == [(0, b"abc")]
+    assert middleware._parse_digest_header(b"sha-512=abc") == []
+    assert middleware._parse_digest_header(b"md5=abc") is None
+    assert middleware._parse_digest_header(b"sha-256") is None
+    assert middleware._parse_digest_header(b"sha-512=a, sha-256 = b ") == [(0, b"b")]
+    assert middleware._parse_digest_header(b"sha-256=a, md5=b") is None
+    assert middleware._parse_digest_header(b"sha-256=a, =b") is None
+
+
+def test_send_is_not_wrapped():
+    sends = []
+
+    async def asgi_app(scope, receive, send):
+        sends.append(send)
+        message = await receive()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": message["body"]})
+
+    middleware = Middleware(asgi_app)
+    body = b"hello world"
+    digest = DigestHeaderAlgorithm.make_digest_header(
+        body, algorithms=[DigestHeaderAlgorithm.SHA256]
+    )
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/echo",
+        "headers": [(b"digest", digest.header_value.encode())],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(middleware(scope, receive, send))
+    assert sends == [send]
+    assert sent[0]["status"] == 200
+    assert sent[1]["body"] == body
+
+
+def test_received_messages_are_replayed():
+    received = []
+
+    async def asgi_app(scope, receive, send):
+        more_body = True
+        while more_body:
+            message = await receive()
+            received.append(message)
+            more_body = message["more_body"]
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    middleware = Middleware(asgi_app)
+    body = b"hello world"
+    digest = DigestHeaderAlgorithm.make_digest_header(
+        body, algorithms=[DigestHeaderAlgorithm.SHA256]
+    )
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/echo",
+        "headers": [(b"digest", digest.header_value.encode())],
+    }
+    messages = [
+        {"type": "http.request", "body": body[:5], "more_body": True},
+        {"type": "http.request", "body": body[5:], "more_body": False},
+    ]
+    pending = list(messages)
+    sent = []
+
+    async def receive():
+        return pending.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(middleware(scope, receive, send))
+    assert sent[0]["status"] == 200
+    # The original messages are passed on, so the body is not copied
+    assert len(received) == 2
+    assert all(a is b for a, b in zip(received, messages))
+
+
+def test_instance_bytes_callback_stream():
+    async def streamed_body_bytes(request: Request) -> bytes:
+        body = b""
+        async for chunk in request.stream():
+            body += chunk
+        return body
+
+    app = FastAPI()
+    app.add_middleware(Middleware, instance_bytes_callback=streamed_body_bytes)
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        body = await request.body()
+        return Response(content=body)
+
+    client = TestClient(app)
+    chunks = [b"hello", b" ", b"world"]
+    body = b"".join(chunks)
+    digest = DigestHeaderAlgorithm.make_digest_header(
+        body, algorithms=[DigestHeaderAlgorithm.SHA256]
+    )
+    response = client.post(
+        "/echo",
+        content=iter(chunks),
+        headers={digest.header_name: digest.header_value},
+    )
+    assert response.status_code == 200
+    assert response.content == body
+
+
+def test_options_are_keyword_only():
+    async def instance_bytes(request: Request) -> bytes:
+        return b""
+
+    with pytest.raises(TypeError):
+        Middleware(FastAPI(), instance_bytes)